@@ -1,20 +1,30 @@
+import asyncio
 import logging
-from datetime import datetime
+import re
+from datetime import time
 from typing import Annotated, List, Dict, Any
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 from starlette import status
 
-from file_handlers import CITIES_FILE, USERS_FILE, WEATHER_FILE, load_data, save_data
+from file_handlers import (
+    CITIES_FILE,
+    USERS_FILE,
+    load_cities,
+    load_users,
+    load_weather,
+    save_data,
+)
 from schemas import (
     CityCreate,
     CityResponse,
     UserCreate,
     UserResponse,
+    UserId,
     WeatherResponse,
-    validate_user_id,
 )
 from services import (
+    cached_json_response,
     get_current_weather,
     get_or_404,
     round_to_nearest_hour,
@@ -24,6 +34,14 @@ router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
+# Текущая погода у Open-Meteo обновляется раз в 15 минут
+CURRENT_WEATHER_CACHE_CONTROL = "public, max-age=900"
+USER_CITIES_CACHE_CONTROL = "private, max-age=60"
+
+ALLOWED_WEATHER_PARAMETERS = frozenset({"temperature", "humidity", "wind_speed", "precipitation"})
+# Время в формате HH:MM, как его принимал datetime.strptime("%H:%M")
+TIME_PATTERN = re.compile(r"([01]?\d|2[0-3]):([0-5]?\d)")
+
 @router.post(
     "/users",
     response_model=UserResponse,
@@ -48,27 +66,26 @@ async def create_user(user: UserCreate):
         HTTPException: Если пользователь с таким именем уже существует.
     """
     # Загружаем данные о пользователях
-    users = await load_data(USERS_FILE)
+    users = await load_users()
 
     # Проверяем, существует ли пользователь с таким именем
-    for user_id, user_data in users.items():
-        if user_data["username"] == user.username:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Пользователь с таким именем уже существует",
-            )
+    if user.username in users["by_username"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Пользователь с таким именем уже существует",
+        )
 
     # Генерируем новый user_id
-    if users:  # Если файл не пустой
-        user_id = str(max(int(user_id) for user_id in users.keys()) + 1)
-    else:  # Если файл пустой
-        user_id = "1"
+    user_id = str(users["next_id"])
+    users["next_id"] += 1
 
     # Создаем нового пользователя
-    users[user_id] = {"username": user.username, "cities": []}
+    users["by_id"][user_id] = {"username": user.username, "cities": []}
+    users["by_username"][user.username] = user_id
     await save_data(USERS_FILE, users)
 
-    return {"id": user_id, "username": user.username}
+    # Данные уже проверены схемой UserCreate, повторная валидация не нужна
+    return UserResponse.model_construct(id=int(user_id), username=user.username)
 
 @router.post(
     "/users/{user_id}/cities/add",
@@ -81,7 +98,7 @@ async def create_user(user: UserCreate):
 )
 async def add_city_for_user(
     city: CityCreate,
-    user_id: int = Depends(validate_user_id),
+    user_id: UserId,
 ):
     """
     Добавляет город для указанного пользователя.
@@ -100,59 +117,65 @@ async def add_city_for_user(
         HTTPException: Если пользователь не найден или произошла ошибка при запросе погоды.
     """
     # Загружаем данные
-    users = await load_data(USERS_FILE)
-    cities = await load_data(CITIES_FILE)
+    users, cities = await asyncio.gather(load_users(), load_cities())
 
     # Проверяем, существует ли пользователь
-    await get_or_404(user_id, users)
+    user_data = await get_or_404(user_id, users["by_id"])
 
     # Ищем город по имени
-    city_id = None
-    for c_id, c_data in cities.items():
-        if c_data["name"] == city.name:
-            city_id = c_id
-            break
+    city_id = cities["by_name"].get(city.name)
+    new_city = False
 
     # Если город не найден, добавляем его
     if not city_id:
-        city_id = str(len(cities) + 1)
-
         # Получаем прогноз погоды для нового города
         try:
             weather_data = await get_current_weather(city.latitude, city.longitude)
-            timezone = weather_data.get("timezone")  # Извлекаем временную зону
-
-            # Сохраняем данные о городе
-            cities[city_id] = {
-                "name": city.name,
-                "latitude": city.latitude,
-                "longitude": city.longitude,
-                "timezone": timezone,  # Добавляем временную зону
-            }
-            await save_data(CITIES_FILE, cities)
-
-            # Сохраняем прогноз погоды
-            await save_weather_forecast(city_id, weather_data)
+
+            # Пока ждали ответа API, этот город мог добавить параллельный запрос.
+            # Поиск и создание идут без await между ними, поэтому дубликата не будет
+            city_id = cities["by_name"].get(city.name)
+            if not city_id:
+                city_id = str(len(cities["by_id"]) + 1)
+                timezone = weather_data.get("timezone")  # Извлекаем временную зону
+
+                # Сохраняем данные о городе
+                cities["by_id"][city_id] = {
+                    "name": city.name,
+                    "latitude": city.latitude,
+                    "longitude": city.longitude,
+                    "timezone": timezone,  # Добавляем временную зону
+                }
+                cities["by_name"][city.name] = city_id
+                new_city = True
         except HTTPException as e:
             return {"message": f"Ошибка при получении прогноза погоды: {e.detail}"}
         except Exception as e:
             return {"message": f"Произошла ошибка: {str(e)}"}
 
+    # Сначала сохраняем город и его прогноз, и только потом связь с пользователем:
+    # если запись прервется, users.json не будет ссылаться на несохраненный город
+    if new_city:
+        await asyncio.gather(
+            save_data(CITIES_FILE, cities),
+            save_weather_forecast(city_id, weather_data),
+        )
+
     # Проверяем, есть ли связь между пользователем и городом
-    user_cities = users[str(user_id)].get("cities", [])
+    user_cities = user_data.get("cities", [])
     if city_id in user_cities:
         return {"message": "Пользователь уже добавил этот город"}
 
     # Добавляем город в список городов пользователя
     user_cities.append(city_id)
-    users[str(user_id)]["cities"] = user_cities
+    user_data["cities"] = user_cities
     await save_data(USERS_FILE, users)
 
     return {"message": "Город успешно добавлен"}
 
 @router.get(
     "/weather/current-conditions",
-    response_model=WeatherResponse,
+    response_model=None,
     summary="Получить текущие погодные условия",
     description="""
     Этот эндпоинт возвращает текущие погодные условия для указанных координат (широта и долгота).
@@ -168,23 +191,26 @@ async def add_city_for_user(
     """,
     response_description="Данные о текущей погоде",
     responses={
-        200: {"description": "Данные о текущей погоде успешно получены"},
+        200: {"model": WeatherResponse, "description": "Данные о текущей погоде успешно получены"},
+        304: {"description": "Данные не изменились с момента предыдущего запроса"},
         500: {"description": "Ошибка при получении данных о погоде"},
     },
 )
 async def current_weather(
+    request: Request,
     latitude: Annotated[float, Query(ge=-90, le=90, description="Широта должна быть между -90 и 90")],
     longitude: Annotated[float, Query(ge=-180, le=180, description="Долгота должна быть между -180 и 180")]
-) -> WeatherResponse:
+) -> Response:
     """
     Получает текущие погодные условия для указанных координат.
 
     Args:
+        request (Request): Входящий запрос, используется для проверки If-None-Match.
         latitude (float): Широта (от -90 до 90).
         longitude (float): Долгота (от -180 до 180).
 
     Returns:
-        WeatherResponse: Данные о текущей погоде, включая температуру, скорость ветра и давление.
+        Response: Данные о текущей погоде (WeatherResponse), включая температуру, скорость ветра и давление.
 
     Raises:
         HTTPException: Если данные о погоде недоступны или произошла ошибка при запросе.
@@ -205,60 +231,69 @@ async def current_weather(
     # Берём первое  давление
     pressure_msl = response_data["hourly"]["pressure_msl"][0] if "hourly" in response_data else 0
 
-    return WeatherResponse(
-        temperature=current_weather_data["temperature"],
-        wind_speed=current_weather_data["windspeed"],
-        pressure=pressure_msl,
-    )
+    # Ответ собираем словарем без модели: у полей WeatherResponse фиксированный тип float,
+    # его и приводим явно. Модель остается только для документации в responses
+    weather = {
+        "temperature": float(current_weather_data["temperature"]),
+        "wind_speed": float(current_weather_data["windspeed"]),
+        "pressure": float(pressure_msl),
+    }
+
+    return cached_json_response(request, weather, CURRENT_WEATHER_CACHE_CONTROL)
 
 @router.get(
     "/users/{user_id}/cities/",
-    response_model=List[CityResponse],
+    response_model=None,
     summary="Получить список городов пользователя",
     description="Возвращает список всех городов, связанных с указанным пользователем.",
     response_description="Список городов пользователя",
     responses={
-        200: {"description": "Список городов успешно получен"},
+        200: {"model": List[CityResponse], "description": "Список городов успешно получен"},
+        304: {"description": "Список городов не изменился с момента предыдущего запроса"},
         404: {"description": "Пользователь не найден или города отсутствуют"},
     },
 )
 async def get_user_cities(
-    user_id: int = Depends(validate_user_id),
-) -> List[CityResponse]:
+    request: Request,
+    user_id: UserId,
+) -> Response:
     """
     Получает список городов, связанных с указанным пользователем.
 
     Args:
+        request (Request): Входящий запрос, используется для проверки If-None-Match.
         user_id (int): ID пользователя.
 
     Returns:
-        List[CityResponse]: Список городов пользователя.
+        Response: Список городов пользователя (List[CityResponse]).
 
     Raises:
         HTTPException: Если пользователь не найден или у пользователя нет городов.
     """
-    # Загружаем данные о клиентах и городах
-    users = await load_data(USERS_FILE)
-    cities = await load_data(CITIES_FILE)
+    # Загружаем данные о клиентах
+    users = await load_users()
 
     # Проверяем, существует ли пользователь
-    await get_or_404(user_id, users)
+    user_data = await get_or_404(user_id, users["by_id"])
 
     # Получаем список id городов
-    user_city_ids = users[str(user_id)].get("cities", [])
+    user_city_ids = user_data.get("cities", [])
+    if not user_city_ids:
+        raise HTTPException(status_code=404, detail="У пользователя нет городов")
 
-    # Получаем данные о городах
-    user_cities = []
-    for city_id in user_city_ids:
-        if str(city_id) in cities:
-            city_name = cities[str(city_id)].get("name")
-            if city_name:
-                user_cities.append(CityResponse(name=city_name))
+    # Файл городов читаем только если у пользователя есть города.
+    # Названия попали в хранилище через CityCreate, поэтому ответ собираем без моделей
+    cities = await load_cities()
+    user_cities = [
+        {"name": city["name"]}
+        for city in (cities["by_id"].get(str(city_id)) for city_id in user_city_ids)
+        if city and city.get("name")
+    ]
 
     if not user_cities:
         raise HTTPException(status_code=404, detail="У пользователя нет городов")
 
-    return user_cities
+    return cached_json_response(request, user_cities, USER_CITIES_CACHE_CONTROL)
 
 @router.get(
     "/users/{user_id}/weather",
@@ -269,42 +304,37 @@ async def get_user_cities(
 async def get_weather_at_time(
     city_name: str,
     time_str: str,
-    user_id: int = Depends(validate_user_id),
+    user_id: UserId,
     parameters: str = Query(default="temperature,humidity,wind_speed,precipitation"),
 ) -> Dict[str, Any]:
-    try:
-        # Преобразуем время пользователя в формат datetime.time
-        target_time = datetime.strptime(time_str, "%H:%M").time()
-    except ValueError:
+    # Преобразуем время пользователя в формат datetime.time
+    time_match = TIME_PATTERN.fullmatch(time_str)
+    if not time_match:
         raise HTTPException(
             status_code=400,
             detail="Некорректный формат времени. Используйте формат 'HH:MM'."
         )
+    target_time = time(int(time_match.group(1)), int(time_match.group(2)))
 
     # Округляем время до ближайшего часа
     rounded_time = round_to_nearest_hour(target_time)
 
     # Загружаем данные о пользователях и городах
-    users = await load_data(USERS_FILE)
-    cities = await load_data(CITIES_FILE)
-    weather_data = await load_data(WEATHER_FILE)
+    users, cities, weather_data = await asyncio.gather(load_users(), load_cities(), load_weather())
 
     # Проверяем, что пользователь существует
-    if str(user_id) not in users:
+    user_data = users["by_id"].get(str(user_id))
+    if user_data is None:
         raise HTTPException(
             status_code=404,
             detail=f"Пользователь с ID {user_id} не найден."
         )
 
     # Проверяем, что город есть в списке пользователя
-    user_cities = users[str(user_id)].get("cities", [])
-    city_id = None
-    for city in user_cities:
-        if cities.get(str(city), {}).get("name") == city_name:
-            city_id = str(city)
-            break
+    user_cities = user_data.get("cities", [])
+    city_id = cities["by_name"].get(city_name)
 
-    if not city_id:
+    if city_id not in user_cities:
         raise HTTPException(
             status_code=404,
             detail=f"Город '{city_name}' не найден в списке пользователя."
@@ -320,11 +350,7 @@ async def get_weather_at_time(
 
     # Ищем данные для округленного времени
     rounded_time_str = rounded_time.strftime("%H:%M")
-    weather_at_time = None
-    for timestamp, weather in city_weather.items():
-        if timestamp.endswith(rounded_time_str):
-            weather_at_time = weather
-            break
+    weather_at_time = city_weather.get(rounded_time_str)
 
     if not weather_at_time:
         raise HTTPException(
@@ -332,29 +358,15 @@ async def get_weather_at_time(
             detail=f"Данные о погоде для города '{city_name}' на время '{rounded_time_str}' не найдены."
         )
 
-    # Фильтруем параметры погоды с использованием match-case
+    # Проверяем параметры погоды и выбираем только запрошенные
     selected_parameters = parameters.split(",")
-    response = {}
-    for param in selected_parameters:
-        match param:
-            case "temperature":
-                response["temperature"] = weather_at_time.get("temperature")
-            case "humidity":
-                response["humidity"] = weather_at_time.get("humidity")
-            case "wind_speed":
-                response["wind_speed"] = weather_at_time.get("wind_speed")
-            case "precipitation":
-                response["precipitation"] = weather_at_time.get("precipitation")
-            case _:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Недопустимый параметр: {param}. Доступные параметры: temperature, humidity, wind_speed, precipitation."
-                )
-
-    if not response:
+    invalid_parameter = next(
+        (param for param in selected_parameters if param not in ALLOWED_WEATHER_PARAMETERS), None
+    )
+    if invalid_parameter is not None:
         raise HTTPException(
             status_code=400,
-            detail="Указаны недопустимые параметры. Доступные параметры: temperature, humidity, wind_speed, precipitation."
+            detail=f"Недопустимый параметр: {invalid_parameter}. Доступные параметры: temperature, humidity, wind_speed, precipitation."
         )
 
-    return response
+    return {param: weather_at_time.get(param) for param in selected_parameters}
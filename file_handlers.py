@@ -1,23 +1,124 @@
-import json
-from typing import Dict, Any
+import asyncio
+import os
+from typing import Callable, Dict, Any, Optional, Tuple
 import aiofiles
+import orjson
 
 USERS_FILE = "users.json"
 CITIES_FILE = "cities.json"
 WEATHER_FILE = "weather.json"
 
-async def load_data(filename: str) -> Dict[str, Any]:
+# Разобранное содержимое файлов: имя файла -> (mtime в нс, размер, данные)
+_snapshots: Dict[str, Tuple[int, int, Dict[str, Any]]] = {}
+_write_locks: Dict[str, asyncio.Lock] = {}
+_read_locks: Dict[str, asyncio.Lock] = {}
+
+def _file_signature(filename: str) -> Tuple[int, int]:
+    """
+    Возвращает время изменения и размер файла.
+    """
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+async def load_data(
+    filename: str, convert: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
     """
     Асинхронно загружает данные из JSON-файла.
+    Пока файл не менялся на диске, возвращается уже разобранный снимок из памяти.
+    convert вызывается только после чтения файла и приводит данные к текущему формату на месте.
+    Изменения в возвращенном словаре нужно сохранять через save_data.
     """
-    async with aiofiles.open(filename, mode="r") as file:
-        content = await file.read()
-        return json.loads(content)
+    signature = _file_signature(filename)
+    snapshot = _snapshots.get(filename)
+    if snapshot is not None and snapshot[:2] == signature:
+        return snapshot[2]
+
+    # Одновременные запросы читают файл один раз и получают один и тот же словарь,
+    # иначе изменения одного из них потерялись бы при следующей записи
+    async with _read_locks.setdefault(filename, asyncio.Lock()):
+        signature = _file_signature(filename)
+        snapshot = _snapshots.get(filename)
+        if snapshot is not None and snapshot[:2] == signature:
+            return snapshot[2]
+
+        async with aiofiles.open(filename, mode="rb") as file:
+            content = await file.read()
+        data = orjson.loads(content)
+        if convert is not None:
+            convert(data)
+        _snapshots[filename] = (*signature, data)
+        return data
 
 async def save_data(filename: str, data: Dict[str, Any]):
     """
-    Асинхронно сохраняет данные в JSON-файл.
+    Асинхронно сохраняет данные в JSON-файл и обновляет снимок в памяти.
+    Данные пишутся во временный файл и атомарно подменяют старый через os.replace,
+    поэтому читатели никогда не видят недописанный файл.
+    Если запись не удалась, снимок сбрасывается и следующее чтение возьмет данные с диска.
+    """
+    async with _write_locks.setdefault(filename, asyncio.Lock()):
+        tmp_filename = f"{filename}.tmp"
+        try:
+            async with aiofiles.open(tmp_filename, mode="wb") as file:
+                content = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+                await file.write(content)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            # Снимок мог быть изменен вызывающим кодом и больше не совпадает с файлом
+            _snapshots.pop(filename, None)
+            raise
+        _snapshots[filename] = (*_file_signature(filename), data)
+
+def _convert_legacy_users(users: Dict[str, Any]):
+    """
+    Преобразует пользователей в старом формате {id: пользователь} на месте.
+    """
+    if "by_id" not in users:
+        by_id = dict(users)
+        users.clear()
+        users["by_id"] = by_id
+        users["by_username"] = {user["username"]: user_id for user_id, user in by_id.items()}
+        users["next_id"] = max(map(int, by_id), default=0) + 1
+
+async def load_users() -> Dict[str, Any]:
+    """
+    Загружает пользователей в виде {"by_id": {...}, "by_username": {...}, "next_id": int}.
+    Старый формат преобразуется один раз, при чтении файла.
+    """
+    return await load_data(USERS_FILE, _convert_legacy_users)
+
+def _convert_legacy_cities(cities: Dict[str, Any]):
+    """
+    Преобразует города в старом формате {id: город} на месте.
+    """
+    if "by_id" not in cities:
+        by_id = dict(cities)
+        cities.clear()
+        cities["by_id"] = by_id
+        cities["by_name"] = {city["name"]: city_id for city_id, city in by_id.items()}
+
+async def load_cities() -> Dict[str, Any]:
+    """
+    Загружает города в виде {"by_id": {...}, "by_name": {...}}.
+    Старый формат преобразуется один раз, при чтении файла.
+    """
+    return await load_data(CITIES_FILE, _convert_legacy_cities)
+
+def _convert_legacy_weather(weather: Dict[str, Any]):
+    """
+    Преобразует прогнозы в старом формате {city_id: {ISO-время: {...}}} на месте.
+    """
+    for city_id, city_weather in weather.items():
+        if "T" in next(iter(city_weather), ""):
+            weather[city_id] = {
+                timestamp[11:16]: {"time": timestamp, **record}
+                for timestamp, record in city_weather.items()
+            }
+
+async def load_weather() -> Dict[str, Any]:
+    """
+    Загружает прогнозы в виде {city_id: {"HH:MM": {"time": ISO-время, ...}}}.
+    Старый формат преобразуется один раз, при чтении файла, а не при каждом обращении.
     """
-    async with aiofiles.open(filename, mode="w") as file:
-        content = json.dumps(data, indent=4)
-        await file.write(content)
+    return await load_data(WEATHER_FILE, _convert_legacy_weather)
@@ -1,6 +1,6 @@
 from typing import Annotated
 
-from fastapi import Path, HTTPException
+from fastapi import Path
 from pydantic import BaseModel, Field
 
 
@@ -34,15 +34,6 @@ class WeatherResponse(BaseModel):
     pressure: float = Field(..., description="Атмосферное давление в гектопаскалях (hPa)")
 
 
-async def validate_user_id(
-    user_id: Annotated[int, Path(ge=1, description="ID пользователя должен быть положительным числом")]
-) -> int:
-    """
-    Валидирует ID пользователя.
-    """
-    if user_id < 1:
-        raise HTTPException(
-            status_code=400,
-            detail="ID пользователя должен быть положительным числом"
-        )
-    return user_id
+# ID пользователя из пути. Проверку выполняет Path(ge=1) на этапе валидации запроса,
+# отдельная зависимость для этого не нужна
+UserId = Annotated[int, Path(ge=1, description="ID пользователя должен быть положительным числом")]
@@ -1,15 +1,15 @@
 import asyncio
-import json
 import logging
+import os
 from contextlib import asynccontextmanager
-from pathlib import Path
 
-import aiofiles
+import orjson
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
 import endpoints
 from file_handlers import CITIES_FILE, USERS_FILE, WEATHER_FILE
-from services import update_weather_data
+from services import WEATHER_UPDATE_INTERVAL, close_http_client, get_http_client, update_weather_data
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,17 +20,35 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 task = None
 
+async def run_weather_updates():
+    """
+    Запускает обновление прогноза погоды каждые WEATHER_UPDATE_INTERVAL секунд.
+    Ошибка одного прохода не останавливает следующие.
+    """
+    while True:
+        try:
+            await update_weather_data()
+        except Exception as e:
+            logger.error(f'Ошибка при обновлении погодных данных: {e}')
+        await asyncio.sleep(WEATHER_UPDATE_INTERVAL)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global task
-    # Создаваю файлы, если они не существуют
+    # Создаваю файлы, если они не существуют. O_EXCL делает проверку и создание
+    # одним системным вызовом, существующие файлы не трогаем
     for file in [USERS_FILE, CITIES_FILE, WEATHER_FILE]:
-        if not Path(file).exists():
-            async with aiofiles.open(file, "w") as f:
-                await f.write(json.dumps({}))
+        try:
+            fd = os.open(file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            continue
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps({}))
     logger.info('Запуск приложения')
+    # Общий HTTP-клиент для запросов к Open-Meteo
+    get_http_client()
     # Запускаю задачу обновления прогноза погоды
-    task = asyncio.create_task(update_weather_data())
+    task = asyncio.create_task(run_weather_updates())
     logger.info('Запуск задачи обновлния погодных данных')
     yield
 
@@ -46,10 +64,12 @@ async def lifespan(app: FastAPI):
             logger.error(f'Ошибка при остановке задачи: {e}')
         finally:
             # Проверяем, есть ли исключение в задаче
-            if task.done() and task.exception():
+            if task.done() and not task.cancelled() and task.exception():
                 logger.error(f'Ошибка в задаче: {task.exception()}')
 
-app = FastAPI(lifespan=lifespan)
+    await close_http_client()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 app.include_router(endpoints.router)
 
 if __name__ == "__main__":
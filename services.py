@@ -1,158 +1,334 @@
 import asyncio
+import hashlib
 import logging
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta, time
-from typing import Dict, Any
+from functools import lru_cache
+from time import monotonic
+from typing import Dict, Any, List, Optional, Tuple
 
 import httpx
-from fastapi import HTTPException
+import orjson
+from fastapi import HTTPException, Request, Response
 from starlette import status
 from zoneinfo import ZoneInfo
 
-from file_handlers import save_data, load_data, WEATHER_FILE, CITIES_FILE
+from file_handlers import save_data, load_cities, load_weather, WEATHER_FILE
 
 logger = logging.getLogger(__name__)
 
-async def get_or_404(user_id: int, users_data: Dict[str, Any]):
+OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+# Неизменяемая часть параметров запроса, координаты добавляются при вызове
+OPEN_METEO_PARAMS = {
+    "current_weather": True,
+    "hourly": "temperature_2m,relativehumidity_2m,pressure_msl,windspeed_10m,precipitation",
+    "forecast_days": 1,
+    "timezone": "auto",
+}
+OPEN_METEO_TIMEOUT = httpx.Timeout(connect=5.0, read=10.0, write=5.0, pool=5.0)
+OPEN_METEO_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+# Сколько точек запрашивать у Open-Meteo одним запросом при фоновом обновлении
+OPEN_METEO_BATCH_SIZE = 100
+# Сколько пачек запрашивать одновременно
+OPEN_METEO_CONCURRENCY = 8
+# Как часто фоновая задача обновляет прогнозы, в секундах
+WEATHER_UPDATE_INTERVAL = 900
+
+# Общий HTTP-клиент: соединения с Open-Meteo переиспользуются между запросами
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Кеш ответов Open-Meteo: ключ - координаты, округленные до ~1 км, и текущий час.
+# В пределах часа Open-Meteo отдает тот же почасовой прогноз
+WEATHER_CACHE_TTL = 900
+WEATHER_CACHE_SIZE = 4096
+WeatherCacheKey = Tuple[float, float, int]
+_weather_cache: "OrderedDict[WeatherCacheKey, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_weather_locks: Dict[WeatherCacheKey, asyncio.Lock] = {}
+
+async def get_or_404(user_id: int, users_data: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Проверяем существует ли польователь в базе данных
+    Проверяем существует ли польователь в базе данных и возвращаем его запись
     """
-    if str(user_id) not in users_data:
+    user = users_data.get(str(user_id))
+    if user is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Пользователь не найден",
         )
+    return user
+
+def make_etag(content: bytes) -> str:
+    """
+    Вычисляет слабый ETag по телу ответа.
+    """
+    return f'W/"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+
+def cached_json_response(request: Request, payload: Any, cache_control: str) -> Response:
+    """
+    Сериализует ответ через orjson и проставляет заголовки Cache-Control и ETag.
+    Если ETag из If-None-Match совпадает с текущим, возвращает ответ 304 без тела.
+    """
+    content = orjson.dumps(payload)
+    etag = make_etag(content)
+    headers = {"Cache-Control": cache_control, "ETag": etag}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Сравнение слабое: префикс W/ не учитывается
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in candidates or etag.removeprefix("W/") in candidates:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(content=content, media_type="application/json", headers=headers)
+
+def _forecast_records(hourly_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Преобразует почасовые массивы Open-Meteo в записи о погоде по ключу "HH:MM".
+    """
+    return {
+        # Время прогноза - строка в формате ISO, "HH:MM" начинается с 11-го символа
+        forecast_time[11:16]: {
+            "time": forecast_time,
+            "temperature": temperature,
+            "humidity": humidity,
+            "wind_speed": wind_speed,
+            "precipitation": precipitation,
+        }
+        for forecast_time, temperature, humidity, wind_speed, precipitation in zip(
+            hourly_data.get("time", []),
+            hourly_data.get("temperature_2m", []),
+            hourly_data.get("relativehumidity_2m", []),
+            hourly_data.get("windspeed_10m", []),
+            hourly_data.get("precipitation", []),
+        )
+    }
 
 async def save_weather_forecast(city_id: str, weather_data: Dict[str, Any]):
     """
     Сохраняет прогноз погоды в файл weather.json.
+    Записи хранятся по ключу "HH:MM", полное время прогноза лежит в поле "time".
     """
-    hourly_data = weather_data.get("hourly", {})
-    times = hourly_data.get("time", [])
-    temperatures = hourly_data.get("temperature_2m", [])
-    humidities = hourly_data.get("relativehumidity_2m", [])
-    wind_speeds = hourly_data.get("windspeed_10m", [])
-    precipitations = hourly_data.get("precipitation", [])
-
     # Загружаем текущие данные о погоде
-    weather = await load_data(WEATHER_FILE)
+    weather = await load_weather()
 
     # Создаем записи о погоде для города
-    weather[city_id] = {}
-    for i in range(len(times)):
-        forecast_time = times[i]  # Время прогноза (строка в формате ISO)
-        weather[city_id][forecast_time] = {
-            "temperature": temperatures[i],
-            "humidity": humidities[i],
-            "wind_speed": wind_speeds[i],
-            "precipitation": precipitations[i],
-        }
+    weather[city_id] = _forecast_records(weather_data.get("hourly", {}))
+
     # Сохраняем обновленные данные
     await save_data(WEATHER_FILE, weather)
 
+def _current_hour() -> int:
+    """
+    Возвращает номер текущего часа по UTC с начала эпохи.
+    """
+    return int(datetime.now(timezone.utc).timestamp()) // 3600
+
+def _weather_cache_key(latitude: float, longitude: float) -> WeatherCacheKey:
+    """
+    Строит ключ кеша: с началом нового часа старые ответы больше не используются.
+    """
+    return round(latitude, 2), round(longitude, 2), _current_hour()
+
+def _weather_cache_get(key: WeatherCacheKey) -> Optional[Dict[str, Any]]:
+    """
+    Возвращает закешированный ответ, если он еще не устарел.
+    """
+    entry = _weather_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, data = entry
+    if monotonic() > expires_at:
+        del _weather_cache[key]
+        return None
+    _weather_cache.move_to_end(key)
+    return data
+
+def _weather_cache_put(key: WeatherCacheKey, data: Dict[str, Any]):
+    """
+    Сохраняет ответ в кеш, вытесняя давно не использованные записи.
+    """
+    _weather_cache[key] = (monotonic() + WEATHER_CACHE_TTL, data)
+    _weather_cache.move_to_end(key)
+    while len(_weather_cache) > WEATHER_CACHE_SIZE:
+        _weather_cache.popitem(last=False)
+
 async def get_current_weather(latitude: float, longitude: float) -> Dict[str, Any]:
     """
     Получает данные о погоде для указанных координат.
+    Ответы кешируются на WEATHER_CACHE_TTL секунд, одновременные запросы
+    для одних и тех же координат выполняют только один HTTP-запрос.
+    """
+    key = _weather_cache_key(latitude, longitude)
+    data = _weather_cache_get(key)
+    if data is not None:
+        return data
+
+    lock = _weather_locks.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            # Пока ждали блокировку, данные мог загрузить другой запрос
+            data = _weather_cache_get(key)
+            if data is None:
+                data = await _fetch_weather(latitude, longitude)
+                _weather_cache_put(key, data)
+    finally:
+        # Блокировку убираем и при ошибке запроса, иначе словарь растет без ограничений.
+        # Убираем только свою: ее место могла занять новая блокировка другого запроса
+        if _weather_locks.get(key) is lock:
+            del _weather_locks[key]
+    return data
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Возвращает общий HTTP-клиент (HTTP/2, keep-alive), создавая его при первом обращении.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        transport = httpx.AsyncHTTPTransport(retries=3, http2=True, limits=OPEN_METEO_LIMITS)
+        _http_client = httpx.AsyncClient(timeout=OPEN_METEO_TIMEOUT, transport=transport)
+    return _http_client
+
+async def close_http_client():
+    """
+    Закрывает общий HTTP-клиент и его соединения.
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def get_weather_batch(coordinates: List[Tuple[float, float]]) -> List[Dict[str, Any]]:
+    """
+    Получает данные о погоде для нескольких точек одним запросом к Open-Meteo.
+    Ответы возвращаются в порядке координат и заодно обновляют кеш.
     """
-    url = "https://api.open-meteo.com/v1/forecast"
     params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "current_weather": True,
-        "hourly": "temperature_2m,relativehumidity_2m,pressure_msl,windspeed_10m,precipitation",
-        "forecast_days": 1,
-        "timezone": "auto",
+        "latitude": ",".join(str(latitude) for latitude, _ in coordinates),
+        "longitude": ",".join(str(longitude) for _, longitude in coordinates),
+        **OPEN_METEO_PARAMS,
     }
+    data = await _request_open_meteo(params)
 
-    timeout = httpx.Timeout(connect=5.0, read=10.0, write=5.0, pool=5.0)
-    transport = httpx.AsyncHTTPTransport(retries=3)
-
-    async with httpx.AsyncClient(timeout=timeout, transport=transport) as client:
-        try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(
-                status_code=500,
-                detail={
-                    "status_code": e.response.status_code,
-                    "message": str(e),
-                    "response_text": e.response.text,
-                }
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Произошла ошибка: {str(e)}"
-            )
+    # Для одной точки Open-Meteo возвращает объект, а не список
+    forecasts = data if isinstance(data, list) else [data]
+    # Без этой проверки zip молча отбросил бы города без прогноза
+    if len(forecasts) != len(coordinates):
+        raise HTTPException(
+            status_code=500,
+            detail=f"Open-Meteo вернул {len(forecasts)} прогнозов вместо {len(coordinates)}",
+        )
+    for (latitude, longitude), forecast in zip(coordinates, forecasts):
+        _weather_cache_put(_weather_cache_key(latitude, longitude), forecast)
+    return forecasts
+
+async def _fetch_weather(latitude: float, longitude: float) -> Dict[str, Any]:
+    """
+    Запрашивает данные о погоде у Open-Meteo.
+    """
+    return await _request_open_meteo({"latitude": latitude, "longitude": longitude, **OPEN_METEO_PARAMS})
+
+async def _request_open_meteo(params: Dict[str, Any]) -> Any:
+    """
+    Выполняет запрос к Open-Meteo и возвращает разобранный JSON.
+    """
+    try:
+        response = await get_http_client().get(OPEN_METEO_URL, params=params)
+        response.raise_for_status()
+        # orjson разбирает байты тела напрямую, без декодирования в строку
+        return orjson.loads(response.content)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "status_code": e.response.status_code,
+                "message": str(e),
+                "response_text": e.response.text,
+            }
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Произошла ошибка: {str(e)}"
+        )
 
 async def update_weather_data():
     """
-    Обновляет данные о погоде для всех городов каждые 15 минут.
+    Обновляет данные о погоде для всех городов за один проход.
+    Периодический запуск выполняет вызывающая сторона.
     """
-    while True:
-        # Загружаем данные о городах
-        cities = await load_data(CITIES_FILE)
+    # Загружаем данные о городах
+    cities = (await load_cities())["by_id"]
+
+    # Загружаем данные о погоде
+    weather_data = await load_weather()
+
+    # Удаляем старые записи (старше 24 часов)
+    await delete_old_weather_data(weather_data, cities)
+
+    # Обновляем данные пачками городов. Берем копию: пока ждем ответа API,
+    # в общий словарь городов могут добавиться новые записи
+    city_items = list(cities.items())
+    batches = [
+        city_items[start:start + OPEN_METEO_BATCH_SIZE]
+        for start in range(0, len(city_items), OPEN_METEO_BATCH_SIZE)
+    ]
+    semaphore = asyncio.Semaphore(OPEN_METEO_CONCURRENCY)
 
-        # Загружаем данные о погоде
-        weather_data = await load_data(WEATHER_FILE)
+    async def fetch_batch(batch):
+        # Получаем данные о погоде для всей пачки одним запросом
+        async with semaphore:
+            return await get_weather_batch(
+                [(city_info["latitude"], city_info["longitude"]) for _, city_info in batch]
+            )
 
-        # Удаляем старые записи (старше 24 часов)
-        await delete_old_weather_data(weather_data, cities)
+    # Пачки запрашиваем параллельно, ошибка одной пачки не отменяет остальные
+    results = await asyncio.gather(*map(fetch_batch, batches), return_exceptions=True)
 
-        # Обновляем данные для каждого города
-        for city_id, city_info in cities.items():
-            latitude = city_info["latitude"]
-            longitude = city_info["longitude"]
+    for batch, forecasts in zip(batches, results):
+        if isinstance(forecasts, Exception):
+            batch_ids = ", ".join(city_id for city_id, _ in batch)
+            logger.info(f"Ошибка при обновлении данных для городов {batch_ids}: {forecasts}")
+            continue
 
+        for (city_id, _), current_weather in zip(batch, forecasts):
             try:
-                # Получаем данные о погоде
-                current_weather = await get_current_weather(latitude, longitude)
-
-                # Обновляем данные в json
-                if city_id not in weather_data:
-                    weather_data[city_id] = {}
-
-                hourly_data = current_weather["hourly"]
-                for i in range(len(hourly_data["time"])):
-                    timestamp = hourly_data["time"][i]
-                    weather_data[city_id][timestamp] = {
-                        "temperature": hourly_data["temperature_2m"][i],
-                        "humidity": hourly_data["relativehumidity_2m"][i],
-                        "wind_speed": hourly_data["windspeed_10m"][i],
-                        "precipitation": hourly_data["precipitation"][i]
-                    }
+                # Обновляем данные в json: все записи города собираем сразу
+                # и добавляем одним обновлением словаря
+                records = _forecast_records(current_weather["hourly"])
+                weather_data.setdefault(city_id, {}).update(records)
 
             except Exception as e:
                 logger.info(f"Ошибка при обновлении данных для города {city_id}: {e}")
 
-        # Сохраняем данные
-        await save_data(WEATHER_FILE, weather_data)
+    # Сохраняем данные
+    await save_data(WEATHER_FILE, weather_data)
 
-        # Ждем 15 минут перед следующим обновлением
-        await asyncio.sleep(900)
+@lru_cache(maxsize=512)
+def get_zone_info(name: str) -> ZoneInfo:
+    """
+    Возвращает часовой пояс по имени, не перечитывая tzdata при каждом вызове.
+    """
+    return ZoneInfo(name)
 
 async def delete_old_weather_data(weather_data: Dict[str, Any], cities: Dict[str, Any]):
     """
     Удаляет записи о погоде, которые старше 24 часов.
     """
-    now_utc = datetime.now(timezone.utc)  # Текущее время в UTC
+    cutoff_utc = datetime.now(timezone.utc) - timedelta(hours=24)  # Граница в UTC
 
     for city_id, city_weather in weather_data.items():
         # Получаем временную метку города
-        city_timezone = ZoneInfo(cities[city_id]["timezone"])
-
-        # Создаем копию словаря
-        for timestamp in list(city_weather.keys()):
-            # Преобразуем локальное время в объект datetime с временной меткой
-            local_time = datetime.fromisoformat(timestamp).replace(tzinfo=city_timezone)
+        city_timezone = get_zone_info(cities[city_id]["timezone"])
 
-            # Преобразуем локальное время в UTC
-            utc_time = local_time.astimezone(timezone.utc)
+        # Время прогнозов - местные ISO-строки, они сравниваются в хронологическом порядке.
+        # Поэтому границу один раз переводим в местное время города и сравниваем строки
+        cutoff = cutoff_utc.astimezone(city_timezone).strftime("%Y-%m-%dT%H:%M")
 
+        # Создаем копию словаря
+        for time_key, record in list(city_weather.items()):
             # Удаляем записи, старше 24 часов
-            if (now_utc - utc_time) > timedelta(hours=24):
-                del city_weather[timestamp]
+            if record["time"] < cutoff:
+                del city_weather[time_key]
 
 def round_to_nearest_hour(target_time: time) -> time:
     """
@@ -162,15 +338,5 @@ def round_to_nearest_hour(target_time: time) -> time:
     - 10:37 -> 11:00
     - 23:45 -> 00:00
     """
-    # Преобразуем time в datetime для удобства вычислений
-    dummy_date = datetime(1, 1, 1)  # Фиктивная дата
-    full_datetime = datetime.combine(dummy_date, target_time)
-
-    # Округляем
-    if full_datetime.minute >= 30:
-        rounded_datetime = full_datetime.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
-    else:
-        rounded_datetime = full_datetime.replace(minute=0, second=0, microsecond=0)
-
-    # Возвращаем только время
-    return rounded_datetime.time()
+    # Начиная с 30 минут округляем вверх, после 23 часов идет 0
+    return time((target_time.hour + (target_time.minute >= 30)) % 24)
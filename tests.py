@@ -1,16 +1,47 @@
+import asyncio
 import json
 import os
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
 
 import httpx
 import pytest
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
 from starlette import status
 
-from file_handlers import CITIES_FILE, USERS_FILE, WEATHER_FILE
-from services import get_or_404
+import endpoints
+import script
+from endpoints import TIME_PATTERN
+from file_handlers import (
+    CITIES_FILE,
+    USERS_FILE,
+    WEATHER_FILE,
+    load_cities,
+    load_data,
+    load_users,
+    load_weather,
+    save_data,
+)
+import file_handlers
+import services
+from schemas import CityCreate, UserCreate
+from services import cached_json_response, get_or_404, make_etag
 
 BASE_URL = "http://127.0.0.1:8000"
 
+# Ответ Open-Meteo для одной точки в тестах без сети
+FORECAST = {
+    "timezone": "Europe/Moscow",
+    "current_weather": {"temperature": 1.0, "windspeed": 2.0},
+    "hourly": {
+        "time": ["2025-01-19T12:00"],
+        "temperature_2m": [-25.9],
+        "relativehumidity_2m": [80],
+        "windspeed_10m": [3.0],
+        "precipitation": [0.0],
+    },
+}
+
 @pytest.fixture(autouse=True)
 def cleanup_json_files():
     """
@@ -24,6 +55,46 @@ def cleanup_json_files():
             with open(file_path, "w") as file:
                 json.dump({}, file)  # Записываем пустой словарь в файл
 
+class FakeOpenMeteo:
+    """
+    Подмена Open-Meteo: запоминает запросы и отвечает response или ошибкой error.
+    """
+    def __init__(self):
+        self.calls = []
+        self.response = FORECAST
+        self.error = None
+        self.delay = 0
+        self.hour = 100
+
+    async def fetch(self, latitude, longitude):
+        self.calls.append((latitude, longitude))
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+@pytest.fixture
+def offline(tmp_path, monkeypatch):
+    """
+    Фикстура для тестов без сервера: пустые JSON-файлы во временном каталоге,
+    подмененный Open-Meteo и сброшенные кеши в памяти.
+    """
+    monkeypatch.chdir(tmp_path)
+    for file_path in [CITIES_FILE, USERS_FILE, WEATHER_FILE]:
+        with open(file_path, "w") as file:
+            json.dump({}, file)
+
+    fake = FakeOpenMeteo()
+    monkeypatch.setattr(services, "_fetch_weather", fake.fetch)
+    monkeypatch.setattr(services, "_current_hour", lambda: fake.hour)
+    monkeypatch.setattr(services, "_weather_cache", services.OrderedDict())
+    monkeypatch.setattr(services, "_weather_locks", {})
+    monkeypatch.setattr(file_handlers, "_snapshots", {})
+    # Блокировки привязываются к циклу событий, а у каждого теста он свой
+    monkeypatch.setattr(file_handlers, "_read_locks", {})
+    monkeypatch.setattr(file_handlers, "_write_locks", {})
+    return fake
+
 @pytest.mark.asyncio
 async def test_create_user():
     async with httpx.AsyncClient() as client:
@@ -134,7 +205,7 @@ async def test_get_weather_at_time():
 @pytest.mark.asyncio
 async def test_get_or_404_user_exists():
     users_data = {"1": {"username": "test_user"}}
-    await get_or_404(1, users_data)
+    assert await get_or_404(1, users_data) is users_data["1"]
 
 @pytest.mark.asyncio
 async def test_get_or_404_user_not_found():
@@ -143,3 +214,325 @@ async def test_get_or_404_user_not_found():
         await get_or_404(2, users_data)
     assert exc_info.value.status_code == status.HTTP_404_NOT_FOUND
     assert exc_info.value.detail == "Пользователь не найден"
+
+def test_make_etag_depends_only_on_content():
+    assert make_etag(b'{"a":1}') == make_etag(b'{"a":1}')
+    assert make_etag(b'{"a":1}') != make_etag(b'{"a":2}')
+    assert make_etag(b'{"a":1}').startswith('W/"')
+
+def make_request(headers=None):
+    """
+    Собирает запрос Starlette с указанными заголовками.
+    """
+    raw_headers = [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw_headers})
+
+def test_cached_json_response_sets_cache_headers():
+    response = cached_json_response(make_request(), [{"name": "Moscow"}], "private, max-age=60")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.body == b'[{"name":"Moscow"}]'
+    assert response.headers["cache-control"] == "private, max-age=60"
+    assert response.headers["etag"] == make_etag(response.body)
+
+@pytest.mark.parametrize("if_none_match", [
+    "{etag}",
+    "{strong}",
+    "*",
+    '"other", {etag}',
+    '"other",{strong}',
+])
+def test_cached_json_response_returns_304_when_etag_matches(if_none_match):
+    etag = cached_json_response(make_request(), {"a": 1}, "public, max-age=900").headers["etag"]
+    header = if_none_match.format(etag=etag, strong=etag.removeprefix("W/"))
+
+    response = cached_json_response(make_request({"If-None-Match": header}), {"a": 1}, "public, max-age=900")
+
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.body == b""
+    assert response.headers["cache-control"] == "public, max-age=900"
+    assert response.headers["etag"] == etag
+
+def test_cached_json_response_returns_body_when_etag_differs():
+    response = cached_json_response(
+        make_request({"If-None-Match": 'W/"other", "another"'}), {"a": 1}, "public, max-age=900"
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.body == b'{"a":1}'
+
+@pytest.mark.asyncio
+async def test_get_current_weather_coalesces_requests(offline):
+    offline.delay = 0.01
+
+    results = await asyncio.gather(
+        *(services.get_current_weather(10.001, 20.001) for _ in range(5))
+    )
+    assert len(offline.calls) == 1
+    assert all(result is results[0] for result in results)
+
+    await services.get_current_weather(10.002, 20.002)
+    assert len(offline.calls) == 1
+
+@pytest.mark.asyncio
+async def test_get_current_weather_releases_lock_on_error(offline, monkeypatch):
+    # Каждый запрос к API ждет свой future, тест сам решает, чем он закончится
+    fetches = []
+
+    async def controlled_fetch(latitude, longitude):
+        fetches.append(asyncio.get_running_loop().create_future())
+        return await fetches[-1]
+
+    monkeypatch.setattr(services, "_fetch_weather", controlled_fetch)
+    key = services._weather_cache_key(10.0, 20.0)
+    error = HTTPException(status_code=500, detail="Open-Meteo недоступен")
+
+    async def start_request():
+        task = asyncio.create_task(services.get_current_weather(10.0, 20.0))
+        await asyncio.sleep(0.01)
+        return task
+
+    first = await start_request()
+    waiter = await start_request()
+    assert len(fetches) == 1
+
+    # Первый запрос падает, ожидающий получает блокировку и делает свой запрос
+    fetches[0].set_exception(error)
+    await asyncio.sleep(0.01)
+    assert len(fetches) == 2
+
+    # Новый запрос создает новую блокировку, пока ожидающий еще ждет ответа
+    newcomer = await start_request()
+    newcomer_lock = services._weather_locks[key]
+    assert len(fetches) == 3
+
+    # Завершение ожидающего не должно убрать чужую блокировку
+    fetches[1].set_exception(error)
+    await asyncio.sleep(0.01)
+    assert services._weather_locks.get(key) is newcomer_lock
+
+    # Поэтому следующий запрос ждет newcomer, а не идет в API сам
+    follower = await start_request()
+    assert len(fetches) == 3
+    fetches[2].set_result(FORECAST)
+
+    for task in (first, waiter):
+        with pytest.raises(HTTPException):
+            await task
+    assert await newcomer is FORECAST
+    assert await follower is FORECAST
+    assert services._weather_locks == {}
+
+@pytest.mark.asyncio
+async def test_get_current_weather_refetches_in_new_hour(offline):
+    await services.get_current_weather(10.0, 20.0)
+    await services.get_current_weather(10.0, 20.0)
+    assert len(offline.calls) == 1
+
+    offline.hour += 1
+    await services.get_current_weather(10.0, 20.0)
+    assert len(offline.calls) == 2
+
+@pytest.mark.asyncio
+async def test_load_data_reuses_snapshot_until_file_changes(tmp_path):
+    path = str(tmp_path / "data.json")
+    await save_data(path, {"1": {"username": "test_user"}})
+
+    first = await load_data(path)
+    assert await load_data(path) is first
+
+    # Файл изменен в обход save_data - снимок должен перечитаться
+    with open(path, "w") as file:
+        json.dump({"2": {"username": "other_user"}}, file)
+    os.utime(path, ns=(0, 0))
+    assert await load_data(path) == {"2": {"username": "other_user"}}
+
+@pytest.mark.asyncio
+async def test_load_users_converts_legacy_format(offline):
+    with open(USERS_FILE, "w") as file:
+        json.dump({"1": {"username": "test_user", "cities": []}, "3": {"username": "other", "cities": []}}, file)
+
+    users = await load_users()
+    assert users["by_id"]["3"]["username"] == "other"
+    assert users["by_username"] == {"test_user": "1", "other": "3"}
+    assert users["next_id"] == 4
+
+@pytest.mark.asyncio
+async def test_load_cities_converts_legacy_format(offline, monkeypatch):
+    with open(CITIES_FILE, "w") as file:
+        json.dump({"1": {"name": "Moscow"}, "2": {"name": "Tomsk"}}, file)
+
+    cities = await load_cities()
+    assert cities["by_id"]["2"]["name"] == "Tomsk"
+    assert cities["by_name"] == {"Moscow": "1", "Tomsk": "2"}
+
+    # Преобразование выполняется только при чтении файла, а не при каждом обращении
+    calls = []
+    monkeypatch.setattr(file_handlers, "_convert_legacy_cities", lambda data: calls.append(1))
+    assert await load_cities() is cities
+    assert calls == []
+
+@pytest.mark.asyncio
+async def test_load_weather_keys_forecast_by_time(offline):
+    with open(WEATHER_FILE, "w") as file:
+        json.dump({"1": {"2025-01-19T12:00": {"temperature": -25.9}}}, file)
+
+    weather = await load_weather()
+    assert weather["1"]["12:00"] == {"time": "2025-01-19T12:00", "temperature": -25.9}
+
+@pytest.mark.asyncio
+async def test_load_weather_converts_only_when_file_is_read(offline, monkeypatch):
+    calls = []
+    convert = file_handlers._convert_legacy_weather
+    monkeypatch.setattr(file_handlers, "_convert_legacy_weather", lambda data: calls.append(1) or convert(data))
+    with open(WEATHER_FILE, "w") as file:
+        json.dump({"1": {"2025-01-19T12:00": {"temperature": -25.9}}}, file)
+
+    weather = await load_weather()
+    assert await load_weather() is weather
+    await save_data(WEATHER_FILE, weather)
+    await load_weather()
+    assert len(calls) == 1
+
+    # Файл изменен в обход save_data - он перечитывается и снова проверяется
+    with open(WEATHER_FILE, "w") as file:
+        json.dump({"1": {"2025-01-19T13:00": {"temperature": 1.0}}}, file)
+    os.utime(WEATHER_FILE, ns=(0, 0))
+    assert (await load_weather())["1"]["13:00"]["temperature"] == 1.0
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_get_weather_batch_requests_all_points_at_once(offline, monkeypatch):
+    requests = []
+
+    async def fake_request(params):
+        requests.append(params)
+        return [{"point": 1}, {"point": 2}]
+
+    monkeypatch.setattr(services, "_request_open_meteo", fake_request)
+
+    forecasts = await services.get_weather_batch([(55.75, 37.61), (59.93, 30.31)])
+    assert forecasts == [{"point": 1}, {"point": 2}]
+    assert len(requests) == 1
+    assert requests[0]["latitude"] == "55.75,59.93"
+    assert await services.get_current_weather(59.93, 30.31) == {"point": 2}
+
+@pytest.mark.asyncio
+async def test_get_weather_batch_rejects_missing_forecasts(offline, monkeypatch):
+    async def fake_request(params):
+        return [{"point": 1}]
+
+    monkeypatch.setattr(services, "_request_open_meteo", fake_request)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await services.get_weather_batch([(55.75, 37.61), (59.93, 30.31)])
+    assert exc_info.value.detail == "Open-Meteo вернул 1 прогнозов вместо 2"
+    assert len(services._weather_cache) == 0
+
+@pytest.mark.asyncio
+async def test_failed_city_write_does_not_link_city_to_user(offline, monkeypatch):
+    user = await endpoints.create_user(UserCreate(username="test_user"))
+
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if dst == CITIES_FILE:
+            raise OSError("Нет места на диске")
+        return replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        await endpoints.add_city_for_user(CityCreate(name="Moscow", latitude=55.75, longitude=37.61), user.id)
+    monkeypatch.setattr(os, "replace", replace)
+
+    with open(USERS_FILE) as file:
+        assert json.load(file)["by_id"][str(user.id)]["cities"] == []
+    # Снимок городов сброшен и снова совпадает с файлом
+    assert (await load_cities())["by_name"] == {}
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_create_city_once(offline):
+    offline.delay = 0.01
+    first = await endpoints.create_user(UserCreate(username="first"))
+    second = await endpoints.create_user(UserCreate(username="second"))
+    city = CityCreate(name="Moscow", latitude=55.75, longitude=37.61)
+
+    results = await asyncio.gather(
+        endpoints.add_city_for_user(city, first.id),
+        endpoints.add_city_for_user(city, second.id),
+    )
+    assert results == [{"message": "Город успешно добавлен"}] * 2
+
+    with open(CITIES_FILE) as file:
+        cities = json.load(file)
+    assert list(cities["by_id"]) == ["1"]
+    assert cities["by_name"] == {"Moscow": "1"}
+    with open(USERS_FILE) as file:
+        users = json.load(file)
+    assert [user["cities"] for user in users["by_id"].values()] == [["1"], ["1"]]
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_keep_both_new_cities(offline):
+    offline.delay = 0.01
+    first = await endpoints.create_user(UserCreate(username="first"))
+    second = await endpoints.create_user(UserCreate(username="second"))
+
+    await asyncio.gather(
+        endpoints.add_city_for_user(CityCreate(name="Moscow", latitude=55.75, longitude=37.61), first.id),
+        endpoints.add_city_for_user(CityCreate(name="Tomsk", latitude=56.49, longitude=84.95), second.id),
+    )
+
+    with open(CITIES_FILE) as file:
+        cities = json.load(file)
+    assert cities["by_name"] == {"Moscow": "1", "Tomsk": "2"}
+    with open(WEATHER_FILE) as file:
+        assert set(json.load(file)) == {"1", "2"}
+
+@pytest.mark.asyncio
+async def test_run_weather_updates_continues_after_error(monkeypatch, caplog):
+    updates = []
+    sleeps = []
+
+    async def flaky_update():
+        updates.append(1)
+        if len(updates) == 1:
+            raise HTTPException(status_code=500, detail="Open-Meteo недоступен")
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+        # Останавливаем цикл после второго прохода
+        if len(sleeps) == 2:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(script, "update_weather_data", flaky_update)
+    monkeypatch.setattr(script.asyncio, "sleep", fake_sleep)
+
+    with pytest.raises(asyncio.CancelledError):
+        await script.run_weather_updates()
+    assert len(updates) == 2
+    assert sleeps == [services.WEATHER_UPDATE_INTERVAL] * 2
+    assert "Open-Meteo недоступен" in caplog.text
+
+@pytest.mark.asyncio
+async def test_delete_old_weather_data_keeps_last_24_hours():
+    now = datetime.now(ZoneInfo("Europe/Moscow"))
+    fresh = (now - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M")
+    stale = (now - timedelta(hours=25)).strftime("%Y-%m-%dT%H:%M")
+    weather_data = {"1": {"a": {"time": fresh}, "b": {"time": stale}}}
+
+    await services.delete_old_weather_data(weather_data, {"1": {"timezone": "Europe/Moscow"}})
+    assert weather_data == {"1": {"a": {"time": fresh}}}
+
+def test_round_to_nearest_hour():
+    assert services.round_to_nearest_hour(time(10, 7)) == time(10, 0)
+    assert services.round_to_nearest_hour(time(10, 30)) == time(11, 0)
+    assert services.round_to_nearest_hour(time(23, 45)) == time(0, 0)
+
+@pytest.mark.parametrize("time_str", ["00:00", "9:5", "23:59", "24:00", "12:60", "12:00:00", "", " 12:00"])
+def test_time_pattern_matches_strptime(time_str):
+    try:
+        datetime.strptime(time_str, "%H:%M")
+        expected = True
+    except ValueError:
+        expected = False
+    assert (TIME_PATTERN.fullmatch(time_str) is not None) == expected